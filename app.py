@@ -1,50 +1,38 @@
 import streamlit as st
 import torch
-import numpy as np
-from transformers import SeamlessM4TModel, AutoProcessor
+from transformers import AutoProcessor
 import io
 import soundfile as sf
+import xxhash
 import streamlit.components.v1 as components
 
+from model_utils import get_amp_dtype, load_pretrained_model, max_new_tokens_for, process_audio
+
 # Cache the model loading with optimizations
 @st.cache_resource
 def load_model():
+    # Load directly on GPU if available
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    
     # Use smaller model for faster inference
-    model = SeamlessM4TModel.from_pretrained(
-        "facebook/seamless-m4t-large", 
-        cache_dir="./models",
-        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-        low_cpu_mem_usage=True
-    )
+    # Load weights in the autocast dtype so matmuls don't recast them
+    model = load_pretrained_model("facebook/seamless-m4t-large", get_amp_dtype() or torch.float32, device)
     processor = AutoProcessor.from_pretrained(
         "facebook/seamless-m4t-large", 
-        cache_dir="./models", 
-        use_fast=False
+        cache_dir="./models"
     )
     
-    # Move to GPU if available
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = model.to(device)
     model.eval()  # Set to evaluation mode
     
+    # On CPU, run Linear layers as int8 (VNNI/AVX2 kernels via fbgemm)
+    if device == "cpu":
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    
+    # Warm up on 1s of silence so the first recording hits cuDNN's cached algorithms
+    translate_audio(torch.zeros(16000), model, processor, device, "eng", "fra")
+    
     return model, processor, device
 
-def process_audio(audio_data, sample_rate):
-    """Process audio to the required format."""
-    # Convert to mono if stereo
-    if len(audio_data.shape) > 1:
-        audio_data = audio_data.mean(axis=1)
-    
-    # Resample to 16kHz if needed
-    if sample_rate != 16000:
-        import torchaudio
-        audio_tensor = torch.tensor(audio_data).unsqueeze(0)
-        resampler = torchaudio.transforms.Resample(sample_rate, 16000)
-        audio_tensor = resampler(audio_tensor)
-        audio_data = audio_tensor.squeeze().numpy()
-    
-    return audio_data
-
 def translate_audio(audio_data, model, processor, device, src_lang, tgt_lang):
     """Translate audio from source to target language with optimizations."""
     # Process audio input with sampling rate
@@ -54,20 +42,25 @@ def translate_audio(audio_data, model, processor, device, src_lang, tgt_lang):
     inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
     
     # Generate translated speech with optimizations
-    with torch.inference_mode():  # Faster than torch.no_grad()
+    amp_dtype = get_amp_dtype()
+    with torch.inference_mode(), torch.autocast(  # Faster than torch.no_grad()
+        device_type="cuda", dtype=amp_dtype, enabled=device == "cuda" and amp_dtype is not None
+    ):
         output = model.generate(
             **inputs, 
             tgt_lang=tgt_lang, 
             generate_speech=True,
             num_beams=1,  # Greedy decoding for speed
-            max_new_tokens=256  # Limit output length
+            text_max_new_tokens=max_new_tokens_for(audio_data.shape[-1]),  # Scale with input length
+            speech_max_new_tokens=256  # Limit output length
         )
     
-    # Extract audio from output - SeamlessM4T returns (waveform, sample_rate) tuple
-    if isinstance(output, tuple):
-        audio_output = output[0].cpu().numpy().squeeze()
-    else:
-        audio_output = output.cpu().numpy().squeeze()
+    # Extract audio from output - SeamlessM4T returns (waveform, waveform_lengths) tuple
+    audio_tensor = output[0] if isinstance(output, tuple) else output
+    
+    # Flatten on the device and copy to the host once, as float32 since
+    # soundfile (and NumPy, for bf16) can't take half-precision arrays
+    audio_output = audio_tensor.reshape(-1).to(torch.float32).cpu().numpy()
     
     return audio_output
 
@@ -116,13 +109,13 @@ def main():
     
     if audio_bytes is not None:
         # Check if this is new audio
-        current_audio_hash = hash(audio_bytes.getvalue())
+        current_audio_hash = xxhash.xxh3_64_intdigest(audio_bytes.getvalue())
         
         if st.session_state.last_audio != current_audio_hash:
             st.session_state.last_audio = current_audio_hash
             
             # Read the recorded audio
-            audio_data, sample_rate = sf.read(io.BytesIO(audio_bytes.getvalue()))
+            audio_data, sample_rate = sf.read(io.BytesIO(audio_bytes.getvalue()), dtype='float32')
             
             # In walkie-talkie mode, translate immediately
             if walkie_mode:
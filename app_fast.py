@@ -5,6 +5,7 @@ Then run: streamlit run app_fast.py
 """
 import streamlit as st
 import requests
+import xxhash
 import io
 from pathlib import Path
 
@@ -74,7 +75,7 @@ def main():
     
     if audio_bytes is not None:
         # Check if this is new audio
-        current_audio_hash = hash(audio_bytes.getvalue())
+        current_audio_hash = xxhash.xxh3_64_intdigest(audio_bytes.getvalue())
         
         if st.session_state.last_audio != current_audio_hash:
             st.session_state.last_audio = current_audio_hash
@@ -7,13 +7,18 @@ from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import torch
+from torch.nn.utils.rnn import pad_sequence
 import numpy as np
-from transformers import SeamlessM4TModel, AutoProcessor
+from transformers import AutoProcessor
 import io
 import soundfile as sf
-import torchaudio
-from functools import lru_cache
-import os
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import gc
+import struct
+import traceback
+
+from model_utils import get_amp_dtype, load_pretrained_model, max_new_tokens_for, process_audio
 
 app = FastAPI(title="Live Translate API")
 
@@ -26,57 +31,362 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global model cache
-MODEL_CACHE = {}
-
-@lru_cache(maxsize=1)
-def get_model():
-    """Load and cache the model."""
-    if 'model' not in MODEL_CACHE:
-        print("Loading model...")
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        
-        model = SeamlessM4TModel.from_pretrained(
-            "facebook/seamless-m4t-v2-large",
-            cache_dir="./models",
-            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-            low_cpu_mem_usage=True
-        )
-        processor = AutoProcessor.from_pretrained(
-            "facebook/seamless-m4t-v2-large",
-            cache_dir="./models",
-            use_fast=False
-        )
+# Model state, loaded once at startup
+MODEL = None
+PROCESSOR = None
+DEVICE = None
+AMP_DTYPE = None
+MODEL_LOCK = asyncio.Lock()
+LOAD_TASK = None
+LOAD_ERROR = None
+
+# Dynamic batching: collect up to BATCH_MAX_SIZE requests for at most
+# BATCH_WINDOW_S seconds, then run them through generate() together.
+# All model work happens on one executor thread, which keeps inference serial.
+BATCH_MAX_SIZE = 4
+BATCH_WINDOW_S = 0.01
+REQUEST_QUEUE = None
+BATCH_WORKER = None
+INFERENCE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+
+# Run a full gc.collect() after this many batches (empty_cache runs after each)
+GC_EVERY_N_BATCHES = 32
+BATCHES_SINCE_GC = 0
+
+# Streamed responses vocode the HiFi-GAN input frames (20 ms each) in windows
+# of this many frames, with context frames on both sides so the convolutions
+# see the same neighbours as a full-length pass; the context is trimmed off
+VOCODER_WINDOW_FRAMES = 96
+VOCODER_CONTEXT_FRAMES = 16
+
+# Vocoder input lengths to capture CUDA graphs for; a full window plus its
+# context lands exactly on the largest bucket
+VOCODER_BUCKETS = (64, VOCODER_WINDOW_FRAMES + 2 * VOCODER_CONTEXT_FRAMES)
+
+WAV_HEADER_SIZE = 44
+
+class GraphedHifiGan(torch.nn.Module):
+    """Replay CUDA graphs of the HiFi-GAN vocoder, zero-padding inputs to the nearest bucket."""
+    def __init__(self, hifi_gan, buckets=VOCODER_BUCKETS):
+        super().__init__()
+        self.hifi_gan = hifi_gan
+        self.buckets = buckets
+        self.graphs = {}
+        self.pool = torch.cuda.graph_pool_handle()
+    
+    def capture(self, input_embeds, bucket):
+        static_input = input_embeds.new_zeros(*input_embeds.shape[:-1], bucket)
         
-        model = model.to(device)
-        model.eval()
+        # Warm up on a side stream first, as CUDA graph capture requires
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            self.hifi_gan(static_input)
+        torch.cuda.current_stream().wait_stream(side_stream)
         
-        # Compile model for faster inference (PyTorch 2.0+)
-        if hasattr(torch, 'compile'):
-            try:
-                model = torch.compile(model, mode="reduce-overhead")
-            except Exception as e:
-                print(f"Could not compile model: {e}")
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool):
+            static_output = self.hifi_gan(static_input)
+        return graph, static_input, static_output
+    
+    def capture_buckets(self, batch_size=1):
+        """Capture graphs for every bucket so live requests only replay."""
+        param = next(self.hifi_gan.parameters())
+        for bucket in self.buckets:
+            key = (batch_size, bucket, param.dtype)
+            if key not in self.graphs:
+                example = param.new_zeros(batch_size, self.hifi_gan.conv_pre.in_channels, bucket)
+                self.graphs[key] = self.capture(example, bucket)
+    
+    def forward(self, input_embeds):
+        length = input_embeds.shape[-1]
+        bucket = next((b for b in self.buckets if b >= length), None)
+        if bucket is None or not input_embeds.is_cuda:
+            return self.hifi_gan(input_embeds)
+        
+        key = (input_embeds.shape[0], bucket, input_embeds.dtype)
+        if key not in self.graphs:
+            self.graphs[key] = self.capture(input_embeds, bucket)
+        graph, static_input, static_output = self.graphs[key]
         
-        MODEL_CACHE['model'] = model
-        MODEL_CACHE['processor'] = processor
-        MODEL_CACHE['device'] = device
-        print(f"Model loaded on {device}")
+        # conv_pre's bias makes the zero padding non-zero, so the last few
+        # samples differ slightly from an eager run
+        static_input.zero_()
+        static_input[..., :length].copy_(input_embeds)
+        graph.replay()
+        
+        # HiFi-GAN upsamples by a fixed hop, so trim to the unpadded length
+        hop = static_output.shape[-1] // bucket
+        return static_output[..., :length * hop].clone()
+
+class UnitVocoder(torch.nn.Module):
+    """Stand in for model.vocoder so generate() stops at units, which are vocoded later in windows."""
+    def __init__(self, vocoder):
+        super().__init__()
+        self.vocoder = vocoder
+        self.hop_length = int(np.prod(vocoder.config.upsample_rates))
+        self.units = None
     
-    return MODEL_CACHE['model'], MODEL_CACHE['processor'], MODEL_CACHE['device']
+    def forward(self, input_ids, speaker_id, lang_id):
+        # generate() returns whatever the vocoder does, so keep the units and
+        # hand back an empty waveform instead of vocoding the whole batch here
+        self.units = (input_ids, speaker_id, lang_id)
+        empty = input_ids.new_zeros(input_ids.shape[0], 0, dtype=torch.float32)
+        return empty, input_ids.new_zeros(input_ids.shape[0])
+    
+    def upsample(self, input_ids, speaker_id, lang_id):
+        """Expand one request's units into HiFi-GAN input frames, or None if there are none."""
+        vocoder = self.vocoder
+        units = input_ids[input_ids != vocoder.pad_token_id].view(1, -1)
+        if units.shape[-1] == 0:
+            return None
+        
+        # Same steps as the vocoder's forward, minus the final hifi_gan call
+        hidden = vocoder.unit_embedding(units).transpose(1, 2)
+        log_dur = vocoder.dur_predictor(hidden.transpose(1, 2))
+        dur = torch.clamp(torch.round(torch.expm1(log_dur)).long(), min=1)
+        hidden = torch.repeat_interleave(hidden, dur.view(-1), dim=2)
+        
+        num_frames = hidden.shape[-1]
+        spkr = vocoder.speaker_embedding(speaker_id.view(1, 1)).transpose(1, 2).expand(-1, -1, num_frames)
+        lang = vocoder.language_embedding(lang_id.view(1, 1)).transpose(1, 2).expand(-1, -1, num_frames)
+        return torch.cat([lang, hidden, spkr], dim=1)
+
+def warmup_model(model, processor, device, amp_dtype):
+    """Run one short generate on silence to pay compile/autotune costs at boot."""
+    dummy = np.zeros(16000, dtype=np.float32)
+    inputs = processor(
+        audio=dummy,
+        src_lang="eng",
+        sampling_rate=16000,
+        return_tensors="pt"
+    ).to(device)
+    with torch.inference_mode(), torch.autocast(
+        device_type="cuda", dtype=amp_dtype, enabled=device == "cuda" and amp_dtype is not None
+    ):
+        model.generate(**inputs, tgt_lang="fra", generate_speech=True, num_beams=1, max_new_tokens=16)
+        
+        # Run the unit upsampling once and record the vocoder graphs now
+        # rather than inside user requests
+        if isinstance(getattr(model, 'vocoder', None), UnitVocoder):
+            unit_ids, speaker_ids, lang_ids = model.vocoder.units
+            model.vocoder.upsample(unit_ids[0], speaker_ids[0], lang_ids[0])
+            hifi_gan = model.vocoder.vocoder.hifi_gan
+            if isinstance(hifi_gan, GraphedHifiGan):
+                hifi_gan.capture_buckets()
 
-def process_audio(audio_data, sample_rate):
-    """Process audio to required format."""
-    if len(audio_data.shape) > 1:
-        audio_data = audio_data.mean(axis=1)
+def load_model_impl():
+    """Load, compile and warm up the model."""
+    print("Loading model...")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    amp_dtype = get_amp_dtype()
+    
+    # Load weights in the autocast dtype so matmuls don't recast them
+    model = load_pretrained_model("facebook/seamless-m4t-v2-large", amp_dtype or torch.float32, device)
+    processor = AutoProcessor.from_pretrained(
+        "facebook/seamless-m4t-v2-large",
+        cache_dir="./models"
+    )
+    
+    model.eval()
+    
+    # On CPU, run Linear layers as int8 (VNNI/AVX2 kernels via fbgemm)
+    if device == "cpu":
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    
+    # Compile only the forward pass: generate() drives it step by step,
+    # so compiling the whole module just graph-breaks in the Python loop.
+    # The decoder's KV cache grows every step, so compile with dynamic shapes
+    # instead of reduce-overhead (which would record a CUDA graph per length),
+    # and without fullgraph so unsupported ops fall back to eager segments.
+    eager_forward = model.forward
+    compiled = device == "cuda" and hasattr(torch, 'compile')
+    if compiled:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    
+    # Replay the vocoder from CUDA graphs to skip its per-kernel launch cost
+    if device == "cuda" and hasattr(model, 'vocoder'):
+        model.vocoder.hifi_gan = GraphedHifiGan(model.vocoder.hifi_gan)
     
-    if sample_rate != 16000:
-        audio_tensor = torch.tensor(audio_data).unsqueeze(0)
-        resampler = torchaudio.transforms.Resample(sample_rate, 16000)
-        audio_tensor = resampler(audio_tensor)
-        audio_data = audio_tensor.squeeze().numpy()
+    # Leave vocoding to the response stream
+    if hasattr(model, 'vocoder'):
+        model.vocoder = UnitVocoder(model.vocoder)
     
-    return audio_data
+    # torch.compile is lazy, so compile errors only surface on the first call
+    try:
+        warmup_model(model, processor, device, amp_dtype)
+    except Exception as e:
+        if not compiled:
+            raise
+        print(f"Could not compile model, running eagerly: {e}")
+        model.forward = eager_forward
+        warmup_model(model, processor, device, amp_dtype)
+    
+    print(f"Model loaded on {device}")
+    return model, processor, device, amp_dtype
+
+async def get_model():
+    """Return the loaded model, loading it once if startup hasn't run yet."""
+    global MODEL, PROCESSOR, DEVICE, AMP_DTYPE, REQUEST_QUEUE, BATCH_WORKER, LOAD_ERROR
+    if MODEL is None:
+        async with MODEL_LOCK:
+            if MODEL is None:
+                loop = asyncio.get_running_loop()
+                MODEL, PROCESSOR, DEVICE, AMP_DTYPE = await loop.run_in_executor(INFERENCE_EXECUTOR, load_model_impl)
+                REQUEST_QUEUE = asyncio.Queue()
+                BATCH_WORKER = asyncio.create_task(batch_worker())
+                LOAD_ERROR = None
+    return MODEL, PROCESSOR, DEVICE, AMP_DTYPE
+
+def generate_batch(features, masks, tgt_lang, max_new_tokens):
+    """Generate speech units for requests sharing `tgt_lang`; return each request's vocoder frames."""
+    global BATCHES_SINCE_GC
+    inputs = None
+    try:
+        inputs = {
+            "input_features": pad_sequence(features, batch_first=True),
+            "attention_mask": pad_sequence(masks, batch_first=True)
+        }
+        
+        inputs = {k: v.to(DEVICE) for k, v in inputs.items()}
+        with torch.inference_mode(), torch.autocast(
+            device_type="cuda", dtype=AMP_DTYPE, enabled=DEVICE == "cuda" and AMP_DTYPE is not None
+        ):
+            # text_ limits only the text decoder; speech units keep the fixed cap
+            MODEL.generate(
+                **inputs,
+                tgt_lang=tgt_lang,
+                generate_speech=True,
+                num_beams=1,
+                text_max_new_tokens=max_new_tokens,
+                speech_max_new_tokens=256
+            )
+            unit_ids, speaker_ids, lang_ids = MODEL.vocoder.units
+            frames = [
+                MODEL.vocoder.upsample(unit_ids[i], speaker_ids[i], lang_ids[i])
+                for i in range(len(features))
+            ]
+        
+        print(f"Batch of {len(features)} -> vocoder frames: {[f.shape[-1] if f is not None else 0 for f in frames]}")
+        return frames
+    
+    finally:
+        # Drop per-batch GPU tensors so generate()'s buffers don't creep up VRAM
+        del inputs
+        MODEL.vocoder.units = None
+        if DEVICE == "cuda":
+            torch.cuda.empty_cache()
+        # gc.collect() is slow, so only run it periodically
+        BATCHES_SINCE_GC += 1
+        if BATCHES_SINCE_GC >= GC_EVERY_N_BATCHES:
+            BATCHES_SINCE_GC = 0
+            gc.collect()
+
+def vocode_window(frames, start):
+    """Vocode frames[start:start + VOCODER_WINDOW_FRAMES] to int16 PCM."""
+    num_frames = frames.shape[-1]
+    end = min(start + VOCODER_WINDOW_FRAMES, num_frames)
+    lo = max(0, start - VOCODER_CONTEXT_FRAMES)
+    hi = min(num_frames, end + VOCODER_CONTEXT_FRAMES)
+    hop = MODEL.vocoder.hop_length
+    with torch.inference_mode(), torch.autocast(
+        device_type="cuda", dtype=AMP_DTYPE, enabled=DEVICE == "cuda" and AMP_DTYPE is not None
+    ):
+        waveform = MODEL.vocoder.vocoder.hifi_gan(frames[..., lo:hi])
+    waveform = waveform.reshape(-1)[(start - lo) * hop:(end - lo) * hop]
+    
+    # Quantize to PCM_16 on the device so only 2 bytes/sample cross to the host.
+    # Scale in float32: 32767 isn't representable in fp16/bf16 and rounds
+    # to 32768, which overflows int16 and flips the sign of loud peaks.
+    return waveform.float().mul(32767).round_().clamp_(-32768, 32767).to(torch.int16).cpu().numpy()
+
+async def batch_worker():
+    """Drain REQUEST_QUEUE, batching requests that arrive close together."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await REQUEST_QUEUE.get()]
+        deadline = loop.time() + BATCH_WINDOW_S
+        while len(batch) < BATCH_MAX_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(REQUEST_QUEUE.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        # generate() takes a single tgt_lang, so batch per target language
+        groups = {}
+        for item in batch:
+            groups.setdefault(item[2], []).append(item)
+        
+        for tgt_lang, items in groups.items():
+            try:
+                results = await loop.run_in_executor(
+                    INFERENCE_EXECUTOR,
+                    generate_batch,
+                    [features for features, _, _, _, _ in items],
+                    [mask for _, mask, _, _, _ in items],
+                    tgt_lang,
+                    max(max_new for _, _, _, max_new, _ in items)
+                )
+            except Exception as e:
+                for *_, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (*_, future), frames in zip(items, results):
+                if not future.done():
+                    future.set_result(frames)
+
+def prepare_inputs(audio_bytes, src_lang, processor):
+    """Decode an uploaded file into input features, attention mask and 16kHz length."""
+    audio_data, sample_rate = sf.read(io.BytesIO(audio_bytes), dtype='float32')
+    processed_audio = process_audio(audio_data, sample_rate)
+    inputs = processor(
+        audio=processed_audio,
+        src_lang=src_lang,
+        sampling_rate=16000,
+        return_tensors="pt"
+    )
+    return inputs["input_features"][0], inputs["attention_mask"][0], processed_audio.shape[-1]
+
+def wav_header(num_samples, sample_rate=16000):
+    """Build the 44-byte RIFF header for mono 16-bit PCM."""
+    data_size = num_samples * 2
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b'data', data_size
+    )
+
+async def stream_wav(frames, sample_rate=16000):
+    """Yield the WAV header, then each window's PCM as soon as it is vocoded."""
+    loop = asyncio.get_running_loop()
+    num_frames = frames.shape[-1]
+    # Durations are fixed before vocoding, so the total length is known up front
+    yield wav_header(num_frames * MODEL.vocoder.hop_length, sample_rate)
+    for start in range(0, num_frames, VOCODER_WINDOW_FRAMES):
+        pcm = await loop.run_in_executor(INFERENCE_EXECUTOR, vocode_window, frames, start)
+        yield pcm.astype('<i2', copy=False).tobytes()
+
+@app.on_event("startup")
+async def load_model_on_startup():
+    """Load the model in the background so uvicorn can bind its socket right away."""
+    global LOAD_TASK
+    LOAD_TASK = asyncio.create_task(get_model())
+    LOAD_TASK.add_done_callback(report_load_failure)
+
+def report_load_failure(task):
+    """Print the traceback of a failed background load and keep it for /health."""
+    global LOAD_ERROR
+    if task.cancelled() or task.exception() is None:
+        return
+    e = task.exception()
+    LOAD_ERROR = repr(e)
+    print("ERROR: Model failed to load:")
+    traceback.print_exception(type(e), e, e.__traceback__)
 
 @app.get("/")
 async def root():
@@ -87,9 +397,10 @@ async def root():
 async def health():
     """Health check endpoint."""
     return {
-        "status": "healthy",
-        "model_loaded": 'model' in MODEL_CACHE,
-        "device": MODEL_CACHE.get('device', 'not loaded')
+        "status": "healthy" if LOAD_ERROR is None else "error",
+        "model_loaded": MODEL is not None,
+        "device": DEVICE or 'not loaded',
+        "load_error": LOAD_ERROR
     }
 
 @app.post("/translate")
@@ -101,84 +412,47 @@ async def translate(
     """Translate audio file from source to target language."""
     try:
         # Load model
-        model, processor, device = get_model()
+        _, processor, _, _ = await get_model()
         
         # Read audio file
         audio_bytes = await audio.read()
-        audio_data, sample_rate = sf.read(io.BytesIO(audio_bytes))
         
-        # Process audio
-        processed_audio = process_audio(audio_data, sample_rate)
+        # Decode, resample and extract fbanks off the event loop (default
+        # pool, not INFERENCE_EXECUTOR) so concurrent requests reach the
+        # batcher together
+        loop = asyncio.get_running_loop()
+        features, mask, num_samples = await loop.run_in_executor(
+            None, prepare_inputs, audio_bytes, src_lang, processor
+        )
         
-        # Prepare inputs
-        inputs = processor(audio=processed_audio, src_lang=src_lang, sampling_rate=16000, return_tensors="pt")
-        inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
+        # Hand off to the batch worker and wait for this request's vocoder frames
+        future = loop.create_future()
+        await REQUEST_QUEUE.put((
+            features,
+            mask,
+            tgt_lang,
+            max_new_tokens_for(num_samples),
+            future
+        ))
+        frames = await future
         
-        # Generate translation - SeamlessM4T returns tuple: (text_output, audio_output)
-        with torch.inference_mode():
-            output = model.generate(
-                **inputs,
-                tgt_lang=tgt_lang,
-                generate_speech=True,
-                num_beams=1,
-                max_new_tokens=256
-            )
-        
-        # Output is tuple: (text_sequences, audio_waveform)
-        # We want the audio waveform (second element)
-        if isinstance(output, tuple) and len(output) >= 2:
-            audio_output = output[1].cpu().numpy().squeeze()
-            print(f"Extracted audio from tuple[1], shape: {audio_output.shape}")
-        elif isinstance(output, dict) and 'waveform' in output:
-            audio_output = output['waveform'].cpu().numpy().squeeze()
-            print(f"Extracted audio from dict['waveform'], shape: {audio_output.shape}")
-        else:
-            print(f"ERROR: Unexpected output type: {type(output)}")
-            return {"error": f"Unexpected output format: {type(output)}"}
-        
-        print(f"Audio output shape: {audio_output.shape}, dtype: {audio_output.dtype}, length: {len(audio_output)}")
-        
-        # Ensure audio is 1D and has data
-        if len(audio_output.shape) > 1:
-            audio_output = audio_output.flatten()
-        
-        if len(audio_output) == 0:
+        if frames is None:
             print("ERROR: Generated audio is empty!")
             return {"error": "Generated audio is empty"}
         
-        # Normalize audio if needed
-        if audio_output.dtype != np.float32:
-            audio_output = audio_output.astype(np.float32)
-        
-        # Convert to WAV bytes
-        buffer = io.BytesIO()
-        sf.write(buffer, audio_output, 16000, format='WAV', subtype='PCM_16')
-        buffer.seek(0)
-        
-        # Read back to verify
-        wav_bytes = buffer.read()
-        print(f"WAV file size: {len(wav_bytes)} bytes")
+        # Send the header, then vocode and send the audio window by window
+        wav_size = WAV_HEADER_SIZE + frames.shape[-1] * MODEL.vocoder.hop_length * 2
+        print(f"WAV file size: {wav_size} bytes")
         
-        if len(wav_bytes) == 0:
-            print("ERROR: Failed to create WAV file!")
-            return {"error": "Failed to create WAV file"}
-        
-        buffer.seek(0)
-        return StreamingResponse(buffer, media_type="audio/wav")
+        return StreamingResponse(
+            stream_wav(frames),
+            media_type="audio/wav",
+            headers={"Content-Length": str(wav_size)}
+        )
     
     except Exception as e:
         return {"error": str(e)}
 
-@app.get("/health")
-async def health():
-    """Health check endpoint."""
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    return {
-        "status": "healthy",
-        "device": device,
-        "model_loaded": 'model' in MODEL_CACHE
-    }
-
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8600)
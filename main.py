@@ -7,7 +7,7 @@ def main():
     # Load the model and processor
     print("Loading model... This may take a while on first run.")
     model = SeamlessM4TModel.from_pretrained("facebook/seamless-m4t-v2-large", cache_dir="./models")
-    processor = AutoProcessor.from_pretrained("facebook/seamless-m4t-v2-large", cache_dir="./models", use_fast=False)
+    processor = AutoProcessor.from_pretrained("facebook/seamless-m4t-v2-large", cache_dir="./models")
 
     while True:
         # Get user input for languages
@@ -0,0 +1,122 @@
+"""
+Model loading and audio helpers shared by app.py and fast_api.py.
+"""
+import torch
+import torchaudio
+import numpy as np
+from transformers import SeamlessM4TModel
+from functools import lru_cache
+import glob
+import importlib.util
+import os
+import shutil
+
+# Let FP32 matmuls use TF32 and cache the fastest cuDNN algorithms
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
+def get_amp_dtype():
+    """Pick the autocast dtype for CUDA inference (None disables autocast)."""
+    if not torch.cuda.is_available():
+        return None
+    if torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    # FP16 tensor cores need compute capability 5.3+
+    if torch.cuda.get_device_capability() >= (5, 3):
+        return torch.float16
+    return None
+
+def get_attn_implementations(dtype):
+    """Attention backends to try, fastest first (FlashAttention-2 needs Ampere+)."""
+    implementations = []
+    if (
+        torch.cuda.is_available()
+        and dtype in (torch.float16, torch.bfloat16)
+        and torch.cuda.get_device_capability() >= (8, 0)
+        and importlib.util.find_spec("flash_attn") is not None
+    ):
+        implementations.append("flash_attention_2")
+    implementations.append("sdpa")
+    return implementations
+
+def pid_alive(pid):
+    """Check whether a process with this PID is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def remove_stale_exports(export_dir):
+    """Delete temp export dirs left behind by processes killed mid-save."""
+    for tmp_dir in glob.glob(f"{glob.escape(export_dir)}.tmp-*"):
+        pid = tmp_dir.rsplit("-", 1)[-1]
+        if pid.isdigit() and int(pid) != os.getpid() and pid_alive(int(pid)):
+            continue
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def load_pretrained_model(model_id, dtype, device):
+    """Load the model onto `device`, exporting half-precision weights once for faster restarts."""
+    export_dir = os.path.join("./models", f"{model_id.split('/')[-1]}-{str(dtype).split('.')[-1]}")
+    from_export = os.path.isdir(export_dir)
+    load_kwargs = dict(
+        cache_dir="./models",
+        torch_dtype=dtype,
+        low_cpu_mem_usage=True,
+        use_safetensors=True if from_export else None,
+        device_map={"": device}
+    )
+    source = export_dir if from_export else model_id
+    for attn_implementation in get_attn_implementations(dtype):
+        try:
+            model = SeamlessM4TModel.from_pretrained(
+                source, attn_implementation=attn_implementation, **load_kwargs
+            )
+            break
+        except ValueError as e:
+            # Only skip backends this model/transformers release rejects
+            if "attention" not in str(e).lower():
+                raise
+            print(f"{attn_implementation} attention unavailable: {e}")
+    else:
+        model = SeamlessM4TModel.from_pretrained(source, **load_kwargs)
+    if not from_export and dtype != torch.float32:
+        # Save to a temp dir and rename it into place, so a crash mid-save
+        # never leaves a partial export that later boots would load
+        remove_stale_exports(export_dir)
+        tmp_dir = f"{export_dir}.tmp-{os.getpid()}"
+        model.save_pretrained(tmp_dir, safe_serialization=True)
+        try:
+            os.replace(tmp_dir, export_dir)
+        except OSError:
+            # Another process finished its export first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return model
+
+@lru_cache(maxsize=8)
+def get_resampler(sample_rate):
+    """Build and cache a resampler to 16kHz (the filter kernel is costly)."""
+    return torchaudio.transforms.Resample(
+        sample_rate, 16000, resampling_method="sinc_interp_hann", dtype=torch.float32
+    )
+
+def process_audio(audio_data, sample_rate):
+    """Process audio to the required format (1D float32 CPU tensor at 16kHz)."""
+    # Convert to mono if stereo, staying in float32
+    if audio_data.ndim > 1:
+        audio_data = np.mean(audio_data, axis=1, dtype=np.float32)
+    
+    # Zero-copy view over the PCM buffer
+    audio_tensor = torch.from_numpy(np.ascontiguousarray(audio_data, dtype=np.float32))
+    
+    # Resample to 16kHz if needed
+    if sample_rate != 16000:
+        audio_tensor = get_resampler(sample_rate)(audio_tensor)
+    
+    return audio_tensor
+
+def max_new_tokens_for(num_samples):
+    """Scale the text decoding budget with input length (~25 tokens per second)."""
+    return max(32, min(256, num_samples // 640 + 16))